@@ -1,14 +1,19 @@
 import numpy as np
+from numpy.lib import recfunctions
 import serial
 import pyqtgraph as pg
-from pyqtgraph.Qt.QtCore import QTimer, pyqtSignal, pyqtSlot, QObject
-from pyqtgraph.Qt.QtWidgets import QLineEdit, QWidget, QVBoxLayout, QGraphicsProxyWidget
-from typing import List, Optional, Tuple
+from pyqtgraph.Qt.QtCore import QTimer, pyqtSlot, QObject
+from typing import List
 from datetime import datetime
 import csv
 import os
 import threading
-import struct
+from itertools import chain
+
+# Binary packet sent by the DAQ: uint32 time stamp (ms) followed by float32 flow (slm).
+_PACKET_DTYPE = np.dtype([("time", "<u4"), ("fm", "<f4")])
+# CSV row format of a packet. 9 significant digits round-trip a float32 exactly.
+_CSV_ROW_FORMAT = "%d,%.9g\n"
 
 
 class RealTimePlot(QObject):
@@ -31,18 +36,37 @@ class RealTimePlot(QObject):
         The list of PlotItem objects.
     _curves : list
         The list of PlotDataItem objects.
-    _datas_x : list
-        The list of x data arrays.
-    _datas_y : list
-        The list of y data arrays.
+    _value_names : list
+        The names of the packet fields plotted as data series.
+    _ring_size : int
+        The capacity of the ring buffers. Larger than _max_size so that a single batch from the
+        serial thread cannot overwrite the newest max_size data points while they are copied.
+    _data_x : ndarray
+        The ring buffer of x data, shared by every data series. Every data point is stored twice,
+        _ring_size apart, so that the newest data points are always a contiguous slice.
+    _data_y : ndarray
+        The ring buffer of y data, one row per data series, stored twice like _data_x.
+    _count : int
+        The total number of data points written to the ring buffers. Only the serial thread writes it,
+        after the data points are stored.
+    _drawn_count : int
+        The value of _count when the plot was last updated.
     _update_rate : int
         The rate at which the plot updates, in milliseconds.
     _time : int
         The current time, in milliseconds.
+    _data_packet : bytearray
+        The preallocated buffer the serial port reads packets into.
+    _data_mv : memoryview
+        The view of _data_packet used to read into it without slicing copies.
+    _stop_reading : Event
+        The event that tells the serial thread to stop reading.
     _timer : QTimer
         The timer that triggers the plot updates.
     _file_path : str
         The file path where the data is stored. Only created when _write_to_file is True.
+    _csv_file : TextIO
+        The line-buffered CSV file kept open while running. Only created when _write_to_file is True.
     _write_to_file : bool
         Whether to create the file or not.
 
@@ -56,12 +80,10 @@ class RealTimePlot(QObject):
         Get the decoded data from the serial port.
     run() -> None
         Starts the PyQtGraph application.
-    __write_to_csv(self, row: List[float]) -> None:
-        Write a row of data to a CSV file.
+    __write_to_csv(self, rows: ndarray) -> None:
+        Write rows of data to a CSV file.
     """
 
-    data_sent = pyqtSignal(tuple)
-
     def __init__(
         self,
         data_set: List[str],
@@ -104,7 +126,6 @@ class RealTimePlot(QObject):
             If True, data is written to a file named file_name. If False, no data is written (default is True).
         """
         QObject.__init__(self)
-        self.data_sent.connect(self.__update)
 
         # Set the update rate and initialize the current time
         self._update_rate = update_rate
@@ -121,22 +142,30 @@ class RealTimePlot(QObject):
         self._num_of_data = len(data_set)
         self._max_size = max_size
 
+        # Each data series is plotted from one field of the packet
+        self._value_names = list(_PACKET_DTYPE.names[1:] if self._time_from_serial else _PACKET_DTYPE.names)
+        if self._num_of_data != len(self._value_names):
+            raise ValueError(
+                f"data_set must name {len(self._value_names)} data series "
+                f"({', '.join(self._value_names)}), got {self._num_of_data}: {data_set}"
+            )
+
         # Create the PyQtGraph application
         self._app = pg.mkQApp()
 
         # Open the serial port
-        self._ser = serial.Serial(port, baud_rate)
-        self._data_packet = bytearray(8)
+        self._ser = serial.Serial(port, baud_rate, timeout=0.1)
+
+        # Preallocate the buffer the serial port reads into. A batch of at most 3 * max_size packets
+        # keeps the plotted window of the 4 * max_size ring buffers intact while __update copies it.
+        self._data_packet = bytearray(_PACKET_DTYPE.itemsize * 3 * self._max_size)
+        self._data_mv = memoryview(self._data_packet)
 
         # Create the PyQtGraph window
         self._win = pg.GraphicsLayoutWidget(show=True)
         self._win.resize(1200, 600)
         self._win.setWindowTitle(window_title)
 
-        self._widget = QWidget()
-        self._layout = QVBoxLayout()
-        self._widget.setLayout(self._layout)
-
         # Enable antialiasing for smoother plot lines
         pg.setConfigOptions(antialias=True)
 
@@ -150,12 +179,26 @@ class RealTimePlot(QObject):
         # Create the curves
         self._curves = [plot.plot(pen="y") for plot in self._plots]
 
-        # Initialize the data arrays
-        self._datas_x = [np.array([])] * self._num_of_data
-        self._datas_y = [np.array([])] * self._num_of_data
+        # Only draw the visible points, downsampled to the screen resolution
+        for curve in self._curves:
+            curve.setDownsampling(auto=True, method="peak")
+            curve.setClipToView(True)
+
+        # Initialize the ring buffers shared by the serial thread (writer) and the plot (reader)
+        self._ring_size = 4 * self._max_size
+        self._data_x = np.zeros(2 * self._ring_size)
+        # The sensor values are float32 on the wire, but a plotted uint32 time stamp needs float64
+        y_dtype = np.float64 if "time" in self._value_names else np.float32
+        self._data_y = np.zeros((self._num_of_data, 2 * self._ring_size), dtype=y_dtype)
+        self._count = 0
+        self._drawn_count = 0
+
+        # Create the event that stops the serial thread
+        self._stop_reading = threading.Event()
 
         # Create the timer
         self._timer = QTimer()
+        self._timer.timeout.connect(self.__update)
 
         # Set the option parameter
         self._write_to_file = write_to_file
@@ -169,107 +212,144 @@ class RealTimePlot(QObject):
             if file_name is None:
                 file_name = datetime.now().strftime("data_%Y-%m-%d,%H-%M-%S.csv")
 
-            # Open the file
+            # Open the file once and keep it open while running
             self._file_path = os.path.join(file_directory_name, file_name)
-            with open(self._file_path, "w", newline="") as file:
-                csv.writer(file).writerow(["time"] + data_set)
+            self._csv_file = open(self._file_path, "w", newline="", buffering=1)
+            csv.writer(self._csv_file).writerow(["time", *data_set])
 
-    @pyqtSlot(tuple)
-    def __update(self, data: Tuple[Optional[int], list[float]]) -> None:
+    @pyqtSlot()
+    def __update(self) -> None:
         """
         Updates the plot with new data from the serial port.
 
         This method is called every `_update_rate` milliseconds by a QTimer object.
-        It reads a line from the serial port, decodes it, and splits it into a list of float values.
-        Each value is appended to the corresponding y data array, and the current time is appended to each x data array.
-        If the length of a data array exceeds `_max_size`, the oldest data point is removed.
-        Finally, the data for each curve is updated with the new x and y data arrays.
+        It draws whatever the serial thread has stored in the ring buffers since the last update,
+        so the plot is redrawn at most once per `_update_rate` regardless of the sensor rate.
+        The newest data points are copied out of the ring buffers once, since the curves keep the
+        arrays they are given. Every curve gets the same x array and its own row of the y array.
         """
-        # Check if there is data available to read from the serial port
-        current_time, values = data
-
-        if values:
-            # Append each value to the corresponding y data array
-            self._datas_y = [
-                np.append(data_y, value) for data_y, value in zip(self._datas_y, values)
-            ]
-            # Append the current time to each x data array
-            self._datas_x = [
-                np.append(data_x, current_time / 1000) for data_x in self._datas_x
-            ]
-
-            # If the length of a data array exceeds max_size, remove the oldest data point
-            if len(self._datas_y[0]) > self._max_size:
-                self._datas_y = [data_y[1:] for data_y in self._datas_y]
-                self._datas_x = [data_x[1:] for data_x in self._datas_x]
-
-            # Update the data for each curve with the new x and y data arrays
-            for curve, data_x, data_y in zip(
-                self._curves, self._datas_x, self._datas_y
-            ):
-                curve.setData(data_x, data_y)
+        # Skip the redraw if no new data point has arrived
+        count = self._count
+        if count == self._drawn_count:
+            return
+        self._drawn_count = count
+
+        # Slice the newest max_size data points out of the ring buffers in chronological order
+        start = max(count - self._max_size, 0)
+        head = start % self._ring_size
+        window = slice(head, head + count - start)
+        data_x = self._data_x[window].copy()
+        datas_y = self._data_y[:, window].copy()
+
+        # Update the data for each curve with the new x and y data arrays
+        for curve, data_y in zip(self._curves, datas_y):
+            curve.setData(data_x, data_y)
 
     @pyqtSlot()
     def __get_data(self, sep=",") -> None:
         """
         Get the decoded data from the serial port.
 
+        Every `_update_rate // _sensor_rate` packets, the current time and the data values
+        are stored in the ring buffers, overwriting the oldest data point once `_ring_size`
+        data points are stored.
+
         Parameters
         ----------
         sep : str, optional
             The separator used to split the serial readings (default is ",").
-
-        Returns
-        -------
-        Tuple[Optional[int], List[float]]
-            Current time and a list of float values each representing data values.
         """
         count = 0
-        while True:
-            data = None, []
-            if self._ser.in_waiting > 0:
-                count += 1
-                self._ser.readinto(self._data_packet)
-                # print(self._data_packet)
-                timeStamp = struct.unpack('I', self._data_packet[0:4])[0] # unit: ms
-                fm_slm = struct.unpack('f', self._data_packet[4:8])[0] # unit: slm
-
-                # values = line.decode().strip().split(sep)
-                raw_data = [timeStamp, fm_slm]
-                if self._time_from_serial:
-                    data = raw_data[0], raw_data[1:]
-                else:
-                    self._time += self._update_rate
-                    data = self._time, raw_data
-
-                # Write value to CSV file.
-                if self._write_to_file:
-                    self.__write_to_csv(raw_data)
-
-                if count == self._update_rate // self._sensor_rate:
-                    self.data_sent.emit(data)
-                    count = 0
+        packet_size = _PACKET_DTYPE.itemsize
+        decimation = max(self._update_rate // self._sensor_rate, 1)
+        filled = 0
+        while not self._stop_reading.is_set():
+            # Move the bytes of an incomplete packet left by the previous batch to the front
+            decoded = filled - filled % packet_size
+            self._data_mv[: filled - decoded] = self._data_mv[decoded:filled]
+            filled -= decoded
+
+            # Read every byte already waiting in one call. When less than a packet is waiting,
+            # wait in the driver for the rest of the packet until the serial timeout elapses.
+            size = max(self._ser.in_waiting, packet_size - filled)
+            size = min(size, len(self._data_packet) - filled)
+            filled += self._ser.readinto(self._data_mv[filled : filled + size])
+
+            num_packets = filled // packet_size
+            if num_packets == 0:
+                continue
+
+            # Decode the whole batch of packets at once, straight from the read buffer
+            records = np.frombuffer(self._data_packet, dtype=_PACKET_DTYPE, count=num_packets)
+            start_time = self._time
+            if not self._time_from_serial:
+                self._time += self._update_rate * num_packets
+
+            # Write value to CSV file.
+            if self._write_to_file:
+                self.__write_to_csv(records)
+
+            # Pick every `decimation`-th packet, continuing the count from the previous batch
+            first = decimation - count - 1
+            count = (count + num_packets) % decimation
+            picked = range(first, num_packets, decimation)
+            if not picked:
+                continue
+
+            # Only the newest max_size points can be displayed
+            shown = picked[-self._max_size :]
+            stored = slice(shown.start, shown.stop, shown.step)
+
+            # Convert the time of the stored packets to seconds once, in a single vector operation
+            if self._time_from_serial:
+                seconds = records["time"][stored] * 1e-3
+            else:
+                elapsed = np.arange(shown.start + 1, shown.stop + 1, shown.step) * self._update_rate
+                seconds = (start_time + elapsed) * 1e-3
+            values = recfunctions.structured_to_unstructured(
+                records[stored][self._value_names], dtype=self._data_y.dtype
+            )
+
+            # Store the data points in the ring buffers for the next plot update.
+            # The count is published last, so the plot never reads a data point that is not written yet.
+            end = self._count + len(picked)
+            heads = np.arange(end - len(shown), end) % self._ring_size
+            for offset in (0, self._ring_size):
+                self._data_x[heads + offset] = seconds
+                self._data_y[:, heads + offset] = values.T
+            self._count += len(picked)
 
     def run(self) -> None:
         """
         Display the plot to the pyqtgraph window.
         """
-        # Connect the timer to the update method
-        threading.Thread(target=self.__get_data, daemon=True).start()
-        # execute the pygtgraph
-        pg.exec()
-
-    def __write_to_csv(self, row: List[float]) -> None:
+        # Start the timer that triggers the plot updates
+        self._timer.start(self._update_rate)
+        reader = threading.Thread(target=self.__get_data, daemon=True)
+        reader.start()
+        try:
+            # execute the pygtgraph
+            pg.exec()
+        finally:
+            # Stop the serial thread before closing the csv file it writes to
+            self._timer.stop()
+            self._stop_reading.set()
+            reader.join()
+            if self._write_to_file:
+                self._csv_file.close()
+
+    def __write_to_csv(self, rows: np.ndarray) -> None:
         """
-        Write a row of data to a CSV file.
+        Write rows of data to a CSV file.
 
         Parameters
         ----------
-        row : List[float]
-            A list of float values representing a row of data.
+        rows : ndarray
+            A structured array of packets, each representing a row of data.
         """
-        with open(self._file_path, "a", newline="") as file:
-            csv.writer(file).writerow(row)
+        # Format the whole batch with one template and write it with a single call
+        fields = tuple(chain.from_iterable(rows.tolist()))
+        self._csv_file.write((_CSV_ROW_FORMAT * len(rows)) % fields)
 
 
 if __name__ == "__main__":